@@ -1,5 +1,6 @@
 import tkinter as tk
 from tkinter import ttk, messagebox
+import functools
 import subprocess
 import os
 import webbrowser
@@ -42,10 +43,20 @@ def start_bot():
 
 def stop_bot():
     global bot_process
+    if bot_process is None or bot_process.poll() is not None:
+        bot_process = None
+        status_var.set("Статус: бот остановлен")
+        messagebox.showinfo("CryptoBay", "Бот не запущен.")
+        return
+
     try:
-        # Грубый вариант: грохнуть все python-процессы
-        # Можно улучшить позже и искать только конкретный.
-        os.system("taskkill /f /im python.exe >nul 2>&1")
+        # Останавливаем только процесс бота, а не все python.exe в системе
+        bot_process.terminate()
+        try:
+            bot_process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            bot_process.kill()
+            bot_process.wait()
         bot_process = None
         status_var.set("Статус: бот остановлен")
         messagebox.showinfo("CryptoBay", "Бот остановлен.")
@@ -57,14 +68,10 @@ def open_telegram():
     webbrowser.open("https://t.me/criptobay_bot")
 
 
-def _parse_version(v: str):
-    parts = []
-    for p in v.split("."):
-        try:
-            parts.append(int(p))
-        except ValueError:
-            parts.append(0)
-    return tuple(parts)
+@functools.lru_cache(maxsize=16)
+def _parse_version(v: str) -> tuple:
+    # Версии — константы из .env, парсим каждую один раз и без исключений
+    return tuple(int(p) if p.isdigit() else 0 for p in v.split("."))
 
 
 def check_updates():
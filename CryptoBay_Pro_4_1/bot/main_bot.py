@@ -1,12 +1,15 @@
 import asyncio
+import functools
 import logging
 import os
-import json
-import datetime as dt
+import re
+import time
 from pathlib import Path
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, Tuple
 
-import requests
+import httpx
+import orjson
+from aiolimiter import AsyncLimiter
 from dotenv import load_dotenv
 
 from aiogram import Bot, Dispatcher, F, types
@@ -22,6 +25,7 @@ from aiogram.types import (
 import matplotlib
 matplotlib.use("Agg")
 import matplotlib.pyplot as plt
+import numpy as np
 
 # === Пути и окружение ===
 
@@ -70,11 +74,29 @@ logger.info("Запуск CryptoBay бота…")
 bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode="HTML"))
 dp = Dispatcher()
 
+# Общий HTTP-клиент (создаётся в main). HTTP/2 мультиплексирует
+# параллельные запросы к CoinGecko и Binance по одному TLS-соединению
+# на хост — наблюдатель, график и хендлеры не ждут друг друга.
+HTTP: Optional[httpx.AsyncClient] = None
+
+# Глобальный лимит Telegram ~30 сообщений/с; держим небольшой запас
+TG_LIMITER = AsyncLimiter(28, 1)
+
+
+async def send_rl(uid: int, text: str) -> Message:
+    async with TG_LIMITER:
+        return await bot.send_message(uid, text)
+
 # В памяти храним настройки уведомлений
 ALERT_ENABLED = set()  # user_ids: set[int]
+# Будит наблюдателя, когда появляется первый подписчик
+ALERTS_EVENT = asyncio.Event()
 
-# Файл с портфелями
+# Портфели шардируются по пользователю: data/portfolios/<uid>.json.
+# Старый единый portfolio.json мигрируется при первом запуске.
 PORTFOLIO_FILE = DATA_DIR / "portfolio.json"
+PORTFOLIO_DIR = DATA_DIR / "portfolios"
+PORTFOLIO_DIR.mkdir(parents=True, exist_ok=True)
 
 # Разрешённые монеты для портфеля/обмена
 SYMBOL_TO_COINGECKO = {
@@ -82,62 +104,216 @@ SYMBOL_TO_COINGECKO = {
     "ETH": "ethereum",
     "USDT": "tether",
 }
+_ALLOWED = frozenset(SYMBOL_TO_COINGECKO)
+_REVERSE = {v: k for k, v in SYMBOL_TO_COINGECKO.items()}
 
 # === Хелперы портфеля ===
 
+# Портфели живут в памяти; на диск пишет фоновая задача portfolio_flusher,
+# причём только шарды реально изменённых пользователей
+PORTFOLIO: Dict[str, Any] = {}
+PORTFOLIO_LOCK = asyncio.Lock()
+PORTFOLIO_DIRTY = asyncio.Event()
+DIRTY_USERS: set = set()
+
+# Правки одного пользователя сериализуем его собственным локом:
+# два почти одновременных изменения не затирают друг друга
+USER_LOCKS: Dict[str, asyncio.Lock] = {}
+
+
+def lock_for(uid: str) -> asyncio.Lock:
+    return USER_LOCKS.setdefault(uid, asyncio.Lock())
+
+
+def _user_path(uid: str) -> Path:
+    return PORTFOLIO_DIR / f"{uid}.json"
+
+
 def load_portfolio() -> Dict[str, Any]:
-    if not PORTFOLIO_FILE.exists():
-        return {}
-    try:
-        with PORTFOLIO_FILE.open("r", encoding="utf-8") as f:
-            return json.load(f)
-    except Exception:
-        logger.exception("Ошибка чтения файла портфеля")
-        return {}
+    data: Dict[str, Any] = {}
+    for path in PORTFOLIO_DIR.glob("*.json"):
+        try:
+            data[path.stem] = orjson.loads(path.read_bytes())
+        except Exception:
+            logger.exception("Ошибка чтения портфеля %s", path.name)
 
+    # Миграция со старого единого portfolio.json
+    if not data and PORTFOLIO_FILE.exists():
+        try:
+            legacy = orjson.loads(PORTFOLIO_FILE.read_bytes())
+            for uid, user in legacy.items():
+                data[uid] = user
+                _write_user(uid, orjson.dumps(user, option=orjson.OPT_INDENT_2))
+            logger.info("Портфели мигрированы в %s", PORTFOLIO_DIR)
+        except Exception:
+            logger.exception("Ошибка миграции файла портфеля")
+    return data
 
-def save_portfolio(data: Dict[str, Any]) -> None:
+
+def _write_user(uid: str, payload: bytes) -> None:
+    path = _user_path(uid)
+    tmp = path.with_suffix(".json.tmp")
+    tmp.write_bytes(payload)
+    os.replace(tmp, path)
+
+
+async def flush_portfolio() -> None:
     try:
-        with PORTFOLIO_FILE.open("w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        async with PORTFOLIO_LOCK:
+            dirty = list(DIRTY_USERS)
+            DIRTY_USERS.clear()
+            payloads = {
+                uid: orjson.dumps(PORTFOLIO.get(uid, {}), option=orjson.OPT_INDENT_2)
+                for uid in dirty
+            }
+        for uid, payload in payloads.items():
+            await asyncio.to_thread(_write_user, uid, payload)
     except Exception:
-        logger.exception("Ошибка сохранения файла портфеля")
+        logger.exception("Ошибка сохранения портфелей")
+
+
+async def portfolio_flusher() -> None:
+    """
+    Отложенная запись портфелей: серия правок за пару секунд
+    схлопывается в одну атомарную запись на диск.
+    """
+    while True:
+        await PORTFOLIO_DIRTY.wait()
+        await asyncio.sleep(2)
+        PORTFOLIO_DIRTY.clear()
+        await flush_portfolio()
 
 
 def format_usd(value: float) -> str:
     return f"{value:,.2f} $".replace(",", " ")
 
+
+# Индекс: (ch > 0) - (ch < 0) + 1 → 0 падение, 1 без изменений, 2 рост
+ARROWS = ("🔻", "➖", "🔺")
+
+# === Кэш ответов API ===
+
+# key -> (момент записи, результат)
+_cache: Dict[str, Any] = {}
+# key -> Future текущего запроса (чтобы N одновременных вызовов делили один HTTP)
+_inflight: Dict[str, asyncio.Future] = {}
+
+
+def cached(ttl: float):
+    """
+    TTL-кэш для async-фетчеров. Повторный вызов в пределах ttl читает
+    из памяти; одновременные вызовы с одним ключом ждут один общий запрос.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args):
+            key = f"{func.__name__}:{args!r}"
+            hit = _cache.get(key)
+            if hit is not None and time.monotonic() - hit[0] < ttl:
+                return hit[1]
+
+            fut = _inflight.get(key)
+            if fut is not None:
+                return await fut
+
+            loop = asyncio.get_running_loop()
+            fut = loop.create_future()
+            _inflight[key] = fut
+            try:
+                result = await func(*args)
+            except BaseException as e:
+                fut.set_exception(e)
+                raise
+            else:
+                _cache[key] = (time.monotonic(), result)
+                fut.set_result(result)
+                return result
+            finally:
+                _inflight.pop(key, None)
+
+        return wrapper
+
+    return decorator
+
 # === Запросы к API ===
 
-def get_btc_overview() -> Optional[Dict[str, Any]]:
+# Валидаторы HTTP-кэша: ключ запроса -> (etag, last_modified, тело)
+_http_validators: Dict[str, tuple] = {}
+
+
+async def fetch_json(url: str, params: Dict[str, Any]) -> Any:
     """
-    BTC: цена, % за 24ч, капитализация, объём.
+    GET с поддержкой ETag / If-Modified-Since: если данные у апстрима
+    не менялись, получаем 304 (~200 байт) и переиспользуем уже
+    разобранное тело вместо повторных килобайт JSON.
+    """
+    key = f"{url}?{sorted(params.items())!r}"
+    entry = _http_validators.get(key)
+
+    headers = {}
+    if entry:
+        etag, last_modified, _ = entry
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+
+    r = await HTTP.get(url, params=params, headers=headers)
+    if r.status_code == 304 and entry:
+        return entry[2]
+    r.raise_for_status()
+    data = orjson.loads(r.content)
+    etag = r.headers.get("ETag")
+    last_modified = r.headers.get("Last-Modified")
+    if etag or last_modified:
+        _http_validators[key] = (etag, last_modified, data)
+    return data
+
+
+@cached(ttl=30)
+async def get_markets_bundle() -> Optional[Dict[str, Dict[str, Any]]]:
+    """
+    Один запрос /coins/markets на все поддерживаемые монеты.
+    Из него собираются обзор BTC, цены для портфеля/обмена
+    и данные для наблюдателя.
     """
     url = "https://api.coingecko.com/api/v3/coins/markets"
     params = {
         "vs_currency": "usd",
-        "ids": "bitcoin",
+        "ids": ",".join(SYMBOL_TO_COINGECKO.values()),
         "price_change_percentage": "24h",
     }
     try:
-        r = requests.get(url, params=params, timeout=15)
-        r.raise_for_status()
-        data = r.json()
-        if not data:
-            return None
-        coin = data[0]
-        return {
-            "price": coin.get("current_price"),
-            "change_24h": coin.get("price_change_percentage_24h"),
-            "market_cap": coin.get("market_cap"),
-            "volume_24h": coin.get("total_volume"),
-        }
+        data = await fetch_json(url, params)
+        bundle = {}
+        for coin in data:
+            sym = _REVERSE.get(coin.get("id"))
+            if sym is None:
+                continue
+            bundle[sym] = {
+                "price": coin.get("current_price"),
+                "change_24h": coin.get("price_change_percentage_24h"),
+                "market_cap": coin.get("market_cap"),
+                "volume_24h": coin.get("total_volume"),
+            }
+        return bundle
     except Exception as e:
-        logger.error("Ошибка запроса BTC с CoinGecko: %s", e)
+        logger.error("Ошибка запроса coins/markets с CoinGecko: %s", e)
+        return None
+
+
+async def get_btc_overview() -> Optional[Dict[str, Any]]:
+    """
+    BTC: цена, % за 24ч, капитализация, объём.
+    """
+    bundle = await get_markets_bundle()
+    if not bundle:
         return None
+    return bundle.get("BTC")
 
 
-def get_top10() -> Optional[List[Dict[str, Any]]]:
+@cached(ttl=60)
+async def get_top10() -> Optional[List[Dict[str, Any]]]:
     url = "https://api.coingecko.com/api/v3/coins/markets"
     params = {
         "vs_currency": "usd",
@@ -147,9 +323,7 @@ def get_top10() -> Optional[List[Dict[str, Any]]]:
         "price_change_percentage": "24h",
     }
     try:
-        r = requests.get(url, params=params, timeout=20)
-        r.raise_for_status()
-        data = r.json()
+        data = await fetch_json(url, params)
         logger.info("Топ-10 получен с CoinGecko")
         return data
     except Exception as e:
@@ -157,45 +331,39 @@ def get_top10() -> Optional[List[Dict[str, Any]]]:
         return None
 
 
-def get_prices_for_symbols(symbols: List[str]) -> Dict[str, float]:
+async def get_prices_for_symbols(symbols: Tuple[str, ...]) -> Dict[str, float]:
     """
     Возвращает цены по символам в USD.
     Пока поддерживаем BTC/ETH/USDT.
     """
-    ids = []
-    reverse = {}
-    for sym in symbols:
-        sym_up = sym.upper()
-        if sym_up in SYMBOL_TO_COINGECKO:
-            cid = SYMBOL_TO_COINGECKO[sym_up]
-            ids.append(cid)
-            reverse[cid] = sym_up
-    if not ids:
+    bundle = await get_markets_bundle()
+    if not bundle:
         return {}
 
-    url = "https://api.coingecko.com/api/v3/simple/price"
-    params = {
-        "ids": ",".join(ids),
-        "vs_currencies": "usd",
-    }
-    try:
-        r = requests.get(url, params=params, timeout=15)
-        r.raise_for_status()
-        data = r.json()
-        prices = {}
-        for cid, item in data.items():
-            sym = reverse.get(cid)
-            if sym and "usd" in item:
-                prices[sym] = float(item["usd"])
-        return prices
-    except Exception as e:
-        logger.error("Ошибка запроса simple/price: %s", e)
-        return {}
+    prices = {}
+    # Одно пересечение множеств вместо проверки принадлежности в цикле
+    for sym in {s.upper() for s in symbols} & _ALLOWED:
+        item = bundle.get(sym)
+        if item and item.get("price") is not None:
+            prices[sym] = float(item["price"])
+    return prices
+
 
+# Кэш графика: часовой бакет последней свечи, путь к PNG и telegram file_id
+CHART_CACHE: Dict[str, Any] = {"ts": None, "path": None, "file_id": None}
 
-def build_btc_chart_png() -> Optional[str]:
+# Figure/Axes создаём один раз: plt.figure на каждый вызов заново
+# инициализирует шрифты и state machine. Состояние matplotlib общее,
+# поэтому рисование сериализуем через CHART_LOCK.
+FIG, AX = plt.subplots(figsize=(9, 4))
+CHART_LOCK = asyncio.Lock()
+
+
+async def build_btc_chart_png() -> Optional[Tuple[str, int]]:
     """
     Строим график BTC/USDT за 24 часа по Binance.
+    Возвращает (путь к PNG, часовой бакет последней свечи).
+    Пока бакет не сменился, переиспользуем уже нарисованный файл.
     """
     url = "https://api.binance.com/api/v3/klines"
     params = {
@@ -204,56 +372,64 @@ def build_btc_chart_png() -> Optional[str]:
         "limit": 24,
     }
     try:
-        r = requests.get(url, params=params, timeout=15)
-        r.raise_for_status()
-        klines = r.json()
+        klines = await fetch_json(url, params)
         logger.info("График BTC получен с Binance")
     except Exception as e:
         logger.error("Ошибка запроса графика с Binance: %s", e)
         return None
 
     try:
-        times = [dt.datetime.fromtimestamp(int(k[0]) / 1000) for k in klines]
-        closes = [float(k[4]) for k in klines]
+        bucket_ts = int(klines[-1][6]) // 1000 // 3600
+        if bucket_ts == CHART_CACHE["ts"] and CHART_CACHE["path"]:
+            return CHART_CACHE["path"], bucket_ts
+
+        # Векторный разбор: один C-проход на колонку вместо питоновского
+        # цикла; при увеличении limit (7д/1м графики) это уже заметно
+        arr = np.asarray(klines, dtype=object)
+        times = (arr[:, 0].astype(np.int64) // 1000).astype("datetime64[s]")
+        closes = arr[:, 4].astype(np.float64)
 
         out_path = CHARTS_DIR / "btc_24h.png"
-        plt.figure(figsize=(9, 4))
-        plt.plot(times, closes)
-        plt.title("BTC/USDT — последние 24 часа (Binance)")
-        plt.xlabel("Время")
-        plt.ylabel("Цена, USDT")
-        plt.grid(alpha=0.3)
-        plt.tight_layout()
-        plt.savefig(out_path)
-        plt.close()
-        return str(out_path)
+        async with CHART_LOCK:
+            AX.clear()
+            AX.plot(times, closes)
+            AX.set_title("BTC/USDT — последние 24 часа (Binance)")
+            AX.set_xlabel("Время")
+            AX.set_ylabel("Цена, USDT")
+            AX.grid(alpha=0.3)
+            FIG.tight_layout()
+            FIG.savefig(out_path)
+        CHART_CACHE["ts"] = bucket_ts
+        CHART_CACHE["path"] = str(out_path)
+        CHART_CACHE["file_id"] = None
+        return str(out_path), bucket_ts
     except Exception as e:
         logger.error("Ошибка построения графика BTC: %s", e)
         return None
 
 # === Клавиатура ===
 
-def main_keyboard() -> ReplyKeyboardMarkup:
-    return ReplyKeyboardMarkup(
-        keyboard=[
-            [
-                KeyboardButton(text="📊 Курсы"),
-                KeyboardButton(text="📈 График BTC"),
-            ],
-            [
-                KeyboardButton(text="🏆 Топ-10"),
-                KeyboardButton(text="💼 Мой портфель"),
-            ],
-            [
-                KeyboardButton(text="🔁 Обменять"),
-                KeyboardButton(text="🔔 Уведомления"),
-            ],
-            [
-                KeyboardButton(text="☎ Поддержка"),
-            ],
+# Кнопки не меняются — собираем разметку один раз при импорте
+MAIN_KB = ReplyKeyboardMarkup(
+    keyboard=[
+        [
+            KeyboardButton(text="📊 Курсы"),
+            KeyboardButton(text="📈 График BTC"),
         ],
-        resize_keyboard=True,
-    )
+        [
+            KeyboardButton(text="🏆 Топ-10"),
+            KeyboardButton(text="💼 Мой портфель"),
+        ],
+        [
+            KeyboardButton(text="🔁 Обменять"),
+            KeyboardButton(text="🔔 Уведомления"),
+        ],
+        [
+            KeyboardButton(text="☎ Поддержка"),
+        ],
+    ],
+    resize_keyboard=True,
+)
 
 # === Хендлеры ===
 
@@ -271,13 +447,13 @@ async def handle_start(message: Message) -> None:
         "• Присылать авто-уведомления об изменении цены\n\n"
         "Выбирай действие ниже 👇"
     )
-    await message.answer(text, reply_markup=main_keyboard())
+    await message.answer(text, reply_markup=MAIN_KB)
 
 
 @dp.message(F.text == "📊 Курсы")
 async def handle_rates(message: Message) -> None:
     logger.info("Курсы запрошены пользователем %s", message.from_user.id)
-    btc = get_btc_overview()
+    btc = await get_btc_overview()
     if not btc:
         await message.answer("⚠ Не удалось получить курс BTC. Попробуй чуть позже.")
         return
@@ -302,38 +478,48 @@ async def handle_rates(message: Message) -> None:
 async def handle_chart(message: Message) -> None:
     logger.info("График запрошен пользователем %s", message.from_user.id)
     await message.answer("⏳ Строю график BTC за 24 часа…")
-    path = await asyncio.to_thread(build_btc_chart_png)
-    if not path:
+    result = await build_btc_chart_png()
+    if not result:
         await message.answer("⚠ Не удалось построить график. Попробуй позже.")
         return
-    photo = FSInputFile(path)
-    await message.answer_photo(photo, caption="BTC/USDT — последние 24 часа (Binance)")
+    path, bucket_ts = result
+
+    caption = "BTC/USDT — последние 24 часа (Binance)"
+    if bucket_ts == CHART_CACHE["ts"] and CHART_CACHE["file_id"]:
+        # Telegram уже знает этот файл — шлём file_id без повторной загрузки
+        await message.answer_photo(CHART_CACHE["file_id"], caption=caption)
+        return
+
+    msg = await message.answer_photo(FSInputFile(path), caption=caption)
+    if msg.photo:
+        CHART_CACHE["file_id"] = msg.photo[-1].file_id
 
 
 @dp.message(F.text == "🏆 Топ-10")
 async def handle_top10(message: Message) -> None:
     logger.info("Топ-10 запрошен пользователем %s", message.from_user.id)
-    data = get_top10()
+    data = await get_top10()
     if not data:
         await message.answer("⚠ Не удалось получить топ-10 монет. Попробуй позже.")
         return
 
-    lines = ["<b>🏆 Топ-10 монет по капитализации</b>\n"]
-    for i, coin in enumerate(data, start=1):
-        name = coin.get("name")
-        sym = coin.get("symbol", "").upper()
-        price = coin.get("current_price")
-        ch = coin.get("price_change_percentage_24h") or 0.0
-        mc = coin.get("market_cap") or 0.0
-
-        arrow = "🔺" if ch > 0 else "🔻" if ch < 0 else "➖"
-        lines.append(
-            f"{i}. <b>{name} ({sym})</b>\n"
-            f"   Цена: {format_usd(price)} | {arrow} {ch:+.2f}%\n"
-            f"   Капа: {format_usd(mc)}\n"
-        )
+    def coin_lines():
+        yield "<b>🏆 Топ-10 монет по капитализации</b>\n"
+        for i, coin in enumerate(data, start=1):
+            name = coin.get("name")
+            sym = coin.get("symbol", "").upper()
+            price = coin.get("current_price")
+            ch = coin.get("price_change_percentage_24h") or 0.0
+            mc = coin.get("market_cap") or 0.0
 
-    await message.answer("\n".join(lines))
+            arrow = ARROWS[(ch > 0) - (ch < 0) + 1]
+            yield (
+                f"{i}. <b>{name} ({sym})</b>\n"
+                f"   Цена: {format_usd(price)} | {arrow} {ch:+.2f}%\n"
+                f"   Капа: {format_usd(mc)}\n"
+            )
+
+    await message.answer("\n".join(coin_lines()))
 
 
 @dp.message(F.text == "💼 Мой портфель")
@@ -341,8 +527,7 @@ async def handle_portfolio_button(message: Message) -> None:
     user_id = str(message.from_user.id)
     logger.info("Портфель запрошен пользователем %s", user_id)
 
-    data = load_portfolio()
-    user = data.get(user_id, {"balances": {}})
+    user = PORTFOLIO.get(user_id, {"balances": {}})
     balances: Dict[str, float] = user.get("balances", {})
 
     if not balances:
@@ -356,8 +541,8 @@ async def handle_portfolio_button(message: Message) -> None:
         )
         return
 
-    symbols = list(balances.keys())
-    prices = get_prices_for_symbols(symbols)
+    symbols = tuple(sorted(balances.keys()))
+    prices = await get_prices_for_symbols(symbols)
 
     total_usd = 0.0
     lines = ["<b>💼 Твой портфель</b>\n"]
@@ -396,9 +581,12 @@ async def handle_alerts_toggle(message: Message) -> None:
     uid = message.from_user.id
     if uid in ALERT_ENABLED:
         ALERT_ENABLED.remove(uid)
+        if not ALERT_ENABLED:
+            ALERTS_EVENT.clear()
         await message.answer("🔕 Авто-уведомления отключены.")
     else:
         ALERT_ENABLED.add(uid)
+        ALERTS_EVENT.set()
         await message.answer(
             f"🔔 Авто-уведомления включены.\n"
             f"Я буду следить за BTC и присылать сигнал,\n"
@@ -417,21 +605,28 @@ async def handle_support(message: Message) -> None:
 
 # === Команды портфеля и обмена (текстовые) ===
 
-@dp.message(F.text.regexp(r"^[\+\-]\s*[A-Za-z]{2,10}\s+[0-9\.,]+$"))
+# Компилируем шаблоны один раз; группы сразу дают знак/символы/сумму
+PORTFOLIO_RE = re.compile(r"^([+\-])\s*([A-Za-z]{2,10})\s+([0-9.,]+)$")
+EX_RE = re.compile(r"^(?:EX|ex)\s+([A-Za-z]{2,10})\s+([A-Za-z]{2,10})\s+([0-9.,]+)$")
+
+
 async def handle_portfolio_edit(message: Message) -> None:
     """
     + BTC 0.01
     - ETH 0.5
     """
     user_id = str(message.from_user.id)
-    text = message.text.strip()
-    sign = 1 if text.startswith("+") else -1
+    m = PORTFOLIO_RE.match(message.text.strip())
+    if not m:
+        await message.answer("⚠ Неверный формат. Пример: <code>+ BTC 0.01</code>")
+        return
 
+    sign_ch, sym, amount_str = m.groups()
+    sign = 1 if sign_ch == "+" else -1
+    sym = sym.upper()
     try:
-        _, sym, amount_str = text.replace("+", "", 1).replace("-", "", 1).split(maxsplit=2)
-        sym = sym.upper()
         amount = float(amount_str.replace(",", "."))
-    except Exception:
+    except ValueError:
         await message.answer("⚠ Неверный формат. Пример: <code>+ BTC 0.01</code>")
         return
 
@@ -443,37 +638,41 @@ async def handle_portfolio_edit(message: Message) -> None:
         await message.answer("⚠ Сумма должна быть больше 0.")
         return
 
-    data = load_portfolio()
-    user = data.get(user_id, {"balances": {}})
-    balances: Dict[str, float] = user.get("balances", {})
+    async with lock_for(user_id):
+        user = PORTFOLIO.get(user_id, {"balances": {}})
+        balances: Dict[str, float] = user.get("balances", {})
 
-    current = balances.get(sym, 0.0)
-    new_amount = current + sign * amount
+        current = balances.get(sym, 0.0)
+        new_amount = current + sign * amount
 
-    if new_amount < 0:
-        await message.answer("⚠ Нельзя уйти в минус по монете.")
-        return
-    if abs(new_amount) < 1e-10:
-        balances.pop(sym, None)
-    else:
-        balances[sym] = new_amount
+        if new_amount < 0:
+            await message.answer("⚠ Нельзя уйти в минус по монете.")
+            return
+        if abs(new_amount) < 1e-10:
+            balances.pop(sym, None)
+        else:
+            balances[sym] = new_amount
 
-    user["balances"] = balances
-    data[user_id] = user
-    save_portfolio(data)
+        user["balances"] = balances
+        PORTFOLIO[user_id] = user
+        DIRTY_USERS.add(user_id)
+        PORTFOLIO_DIRTY.set()
 
     await message.answer(f"✅ Портфель обновлён: {sym} = {new_amount:g}")
     await handle_portfolio_button(message)
 
 
-@dp.message(F.text.regexp(r"^(EX|ex)\s+[A-Za-z]{2,10}\s+[A-Za-z]{2,10}\s+[0-9\.,]+$"))
 async def handle_exchange(message: Message) -> None:
     """
     EX BTC USDT 0.01
     """
     user_id = str(message.from_user.id)
-    parts = message.text.split()
-    _, from_sym, to_sym, amount_str = parts
+    m = EX_RE.match(message.text.strip())
+    if not m:
+        await message.answer("⚠ Неверный формат. Пример: <code>EX BTC USDT 0.01</code>")
+        return
+
+    from_sym, to_sym, amount_str = m.groups()
     from_sym = from_sym.upper()
     to_sym = to_sym.upper()
     amount = float(amount_str.replace(",", "."))
@@ -488,33 +687,34 @@ async def handle_exchange(message: Message) -> None:
         await message.answer("⚠ Сумма должна быть больше 0.")
         return
 
-    data = load_portfolio()
-    user = data.get(user_id, {"balances": {}})
-    balances: Dict[str, float] = user.get("balances", {})
-
-    have = balances.get(from_sym, 0.0)
-    if have < amount:
-        await message.answer(
-            f"⚠ Недостаточно {from_sym}. Сейчас в портфеле: {have:g}"
-        )
-        return
-
-    prices = get_prices_for_symbols([from_sym, to_sym])
+    prices = await get_prices_for_symbols(tuple(sorted((from_sym, to_sym))))
     if from_sym not in prices or to_sym not in prices:
         await message.answer("⚠ Не удалось получить цены для обмена. Попробуй позже.")
         return
 
-    usd_value = prices[from_sym] * amount
-    to_amount = usd_value / prices[to_sym]
+    async with lock_for(user_id):
+        user = PORTFOLIO.get(user_id, {"balances": {}})
+        balances: Dict[str, float] = user.get("balances", {})
+
+        have = balances.get(from_sym, 0.0)
+        if have < amount:
+            await message.answer(
+                f"⚠ Недостаточно {from_sym}. Сейчас в портфеле: {have:g}"
+            )
+            return
+
+        usd_value = prices[from_sym] * amount
+        to_amount = usd_value / prices[to_sym]
 
-    balances[from_sym] = have - amount
-    if balances[from_sym] <= 0:
-        balances.pop(from_sym, None)
-    balances[to_sym] = balances.get(to_sym, 0.0) + to_amount
+        balances[from_sym] = have - amount
+        if balances[from_sym] <= 0:
+            balances.pop(from_sym, None)
+        balances[to_sym] = balances.get(to_sym, 0.0) + to_amount
 
-    user["balances"] = balances
-    data[user_id] = user
-    save_portfolio(data)
+        user["balances"] = balances
+        PORTFOLIO[user_id] = user
+        DIRTY_USERS.add(user_id)
+        PORTFOLIO_DIRTY.set()
 
     await message.answer(
         "✅ Обмен выполнен.\n"
@@ -526,23 +726,37 @@ async def handle_exchange(message: Message) -> None:
 
 @dp.message(F.text)
 async def fallback_menu(message: Message) -> None:
+    # Один хендлер на весь свободный текст: дешёвый префиксный свитч
+    # вместо прогона каждого сообщения через два regex-фильтра
+    text = (message.text or "").strip()
+    if text[:1] in "+-":
+        await handle_portfolio_edit(message)
+        return
+    if text[:3].lower() == "ex ":
+        await handle_exchange(message)
+        return
     # Если пользователь пишет что-то своё — подсказываем про меню
-    await message.answer("Выбери действие на клавиатуре ниже 👇", reply_markup=main_keyboard())
+    await message.answer("Выбери действие на клавиатуре ниже 👇", reply_markup=MAIN_KB)
 
 # === Фоновый наблюдатель за ценой BTC ===
 
 async def price_watcher() -> None:
     """
     Раз в 5 минут смотрим 24h % BTC и при сильных движениях шлём сигнал тем,
-    кто включил авто-уведомления.
+    кто включил авто-уведомления. Без подписчиков спим на событии и не
+    дёргаем API; при ошибках отступаем экспоненциально.
     """
     logger.info("Запуск фонового наблюдателя цен")
     last_state: Dict[int, str] = {}  # user_id -> 'up' | 'down' | 'normal'
+    backoff = 60
 
     while True:
         try:
+            if not ALERT_ENABLED:
+                await ALERTS_EVENT.wait()
+
             if ALERT_ENABLED:
-                btc = get_btc_overview()
+                btc = await get_btc_overview()
                 if btc and btc.get("change_24h") is not None:
                     change = float(btc["change_24h"])
                     state = "normal"
@@ -551,33 +765,54 @@ async def price_watcher() -> None:
                     elif change <= -ALERT_THRESHOLD:
                         state = "down"
 
+                    targets = []
                     for uid in list(ALERT_ENABLED):
                         prev = last_state.get(uid)
                         if state != "normal" and state != prev:
-                            arrow = "🚀" if state == "up" else "📉"
-                            sign_text = "вырос" if state == "up" else "упал"
-                            try:
-                                await bot.send_message(
-                                    uid,
-                                    f"{arrow} BTC {sign_text} на {change:+.2f}% за 24ч.\n"
-                                    f"Текущая цена ≈ {format_usd(btc['price'])}",
-                                )
-                            except Exception as e:
-                                logger.error("Ошибка отправки алерта пользователю %s: %s", uid, e)
+                            targets.append(uid)
                         last_state[uid] = state
+
+                    if targets:
+                        arrow = "🚀" if state == "up" else "📉"
+                        sign_text = "вырос" if state == "up" else "упал"
+                        alert_text = (
+                            f"{arrow} BTC {sign_text} на {change:+.2f}% за 24ч.\n"
+                            f"Текущая цена ≈ {format_usd(btc['price'])}"
+                        )
+                        results = await asyncio.gather(
+                            *(send_rl(uid, alert_text) for uid in targets),
+                            return_exceptions=True,
+                        )
+                        for uid, res in zip(targets, results):
+                            if isinstance(res, Exception):
+                                logger.error("Ошибка отправки алерта пользователю %s: %s", uid, res)
+            backoff = 60
             await asyncio.sleep(300)  # 5 минут
         except Exception as e:
             logger.error("Ошибка в price_watcher: %s", e)
-            await asyncio.sleep(60)
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 600)
 
 # === Точка входа ===
 
 async def main() -> None:
+    global HTTP
+    HTTP = httpx.AsyncClient(
+        http2=True,
+        timeout=15,
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=16),
+    )
+    PORTFOLIO.update(load_portfolio())
     watcher_task = asyncio.create_task(price_watcher())
+    flusher_task = asyncio.create_task(portfolio_flusher())
     try:
         await dp.start_polling(bot)
     finally:
         watcher_task.cancel()
+        flusher_task.cancel()
+        if DIRTY_USERS:
+            await flush_portfolio()
+        await HTTP.aclose()
 
 if __name__ == "__main__":
     asyncio.run(main())